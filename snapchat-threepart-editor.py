@@ -10,13 +10,18 @@ Adds random .mp3 audio from tiktok-audio folder, trimmed to 15 seconds
 """
 
 import os
+import asyncio
 import sys
 import subprocess
 import shutil
 import textwrap
 import random
 import re
+import json
+import functools
 from pathlib import Path
+from collections import deque
+from dataclasses import dataclass
 import tempfile
 
 # Google Sheets imports
@@ -27,13 +32,77 @@ try:
 except ImportError:
     GOOGLE_SHEETS_AVAILABLE = False
 
+# Quiet FFmpeg: only errors on stderr, structured key=value progress on stdout
+FFMPEG_LOG_ARGS = ['-hide_banner', '-loglevel', 'error', '-nostats', '-progress', 'pipe:1']
+
+def run_ffmpeg(cmd, tail_lines=10):
+    """Run an FFmpeg command, keeping only the last few stderr lines in memory"""
+    error_tail = deque(maxlen=tail_lines)
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    for line in process.stderr:
+        error_tail.append(line)
+    process.wait()
+    
+    error_lines = [line.decode('utf-8', errors='replace').strip() for line in error_tail]
+    return process.returncode, [line for line in error_lines if line]
+
+async def run_ffmpeg_async(cmd, tail_lines=10, on_progress=None):
+    """Run an FFmpeg command without blocking the event loop, keeping only the last few stderr lines"""
+    error_tail = deque(maxlen=tail_lines)
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    
+    async def read_progress():
+        # -progress emits key=value blocks, each closed by a progress=continue/end line
+        out_time_ms = 0
+        async for line in process.stdout:
+            key, _, value = line.decode('utf-8', errors='replace').strip().partition('=')
+            if key == 'out_time_ms' and value.isdigit():
+                out_time_ms = int(value)
+            elif key == 'progress' and on_progress:
+                on_progress(out_time_ms / 1_000_000)  # FFmpeg reports out_time_ms in microseconds
+    
+    async def read_errors():
+        async for line in process.stderr:
+            error_tail.append(line)
+    
+    # Drain both pipes together so neither can fill up and stall FFmpeg
+    await asyncio.gather(read_progress(), read_errors())
+    await process.wait()
+    
+    error_lines = [line.decode('utf-8', errors='replace').strip() for line in error_tail]
+    return process.returncode, [line for line in error_lines if line]
+
+@dataclass(slots=True)
+class SheetRecord:
+    """One normalized Google Sheets row"""
+    row_number: int
+    used: bool
+    order: str
+    type: str
+    overlay_text: str
+    mentions_toffee: str
+    
+    @classmethod
+    def from_sheet_row(cls, row_number, row):
+        """Build a record from a get_all_records() row dict"""
+        return cls(
+            row_number=row_number,
+            used=str(row.get('used?', '')).strip().upper() != 'FALSE',
+            order=str(row.get('order', '')).strip(),
+            type=str(row.get('type', '')).strip(),
+            overlay_text=str(row.get('overlay text', '')).strip(),
+            mentions_toffee=str(row.get('mentions toffee?', '')).strip()
+        )
+
 class SnapchatEditor:
     def __init__(self):
         self.script_dir = Path(__file__).parent
         self.input_dir = self.script_dir / "input-images"
         self.output_dir = self.script_dir / "output-video"
-        self.temp_dir = self.script_dir / "temp-videos"  # For individual 5s videos
         self.audio_dir = self.script_dir / "tiktok-audio"
+        self.audio_cache_dir = self.script_dir / "audio-cache"  # Normalized copies of tiktok-audio
         self.credentials_path = self.script_dir / "assets" / "credentials.json"
         
         # Google Sheets configuration
@@ -41,16 +110,38 @@ class SnapchatEditor:
         self.worksheet_name = "SnapchatThreePart"
         self.gc = None
         self.worksheet = None
+        self.sheet_rows = []  # Raw get_all_records() result, fetched once by check_sheet_format()
+        
+        # Sheet type -> image path, filled by build_image_index()
+        self._image_index = {}
+        
+        # Resolved image path -> (width, height), filled lazily by get_image_dimensions()
+        self._dims_cache = {}
+        
+        # Image path -> dimensions, crop and chars per line, see get_image_meta()
+        self._image_meta = {}
         
         # Video settings
         self.segment_duration = 3.0  # Each segment: 5 seconds
         self.total_duration = 9.0   # Total video: 15 seconds (3 segments)
-        self.fps = 30
+        self.fps = 15  # Still images: 15fps looks identical to 30fps at half the encode work
+        self.keyframe_interval = 2  # Seconds between keyframes
+        self.video_encoder = 'libx264'  # Replaced by detect_video_encoder()
+        self.max_hardware_encodes = 2  # Consumer GPU drivers cap concurrent encode sessions
+        self.streamable_output = True  # Videos get uploaded, so keep the moov atom up front
         
         # Supported file types
         self.image_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'}
         self.audio_extensions = {'.mp3'}
         
+        # Audio settings
+        self.audio_volume = '-10dB'
+        self.audio_sample_rate = 44100
+        self.audio_channels = 2
+        self.copyable_audio_codecs = {'aac', 'mp3'}
+        self.audio_info_cache = {}
+        self.audio_choices = []  # Filled by prepare_audio_cache()
+        
         # Text overlay settings
         self.font_size = 20
         self.text_padding = 10
@@ -85,38 +176,149 @@ class SnapchatEditor:
         return audio_files
     
     def select_random_audio(self):
-        """Select a random audio file from the audio directory"""
-        audio_files = self.find_audio_files()
-        
-        if not audio_files:
+        """Select a random (pre-normalized when possible) audio file"""
+        if not self.audio_choices:
             print(f"⚠️  No audio files found in {self.audio_dir}")
             return None
         
-        selected_audio = random.choice(audio_files)
+        selected_audio = random.choice(self.audio_choices)
         print(f"🎵 Selected random audio: {selected_audio.name}")
         return selected_audio
     
-    def find_image_by_type(self, image_type):
-        """Find an image file that matches the specified type"""
+    async def prepare_audio_cache(self, audio_files):
+        """Normalize every audio file once up front so each video can stream-copy its audio"""
+        print(f"🔄 Preparing audio cache in {self.audio_cache_dir.name}/...")
+        
+        # Normalization is CPU-bound, so run at most one FFmpeg per core
+        slots = asyncio.Semaphore(os.cpu_count() or 1)
+        
+        async def normalize_with_slot(audio_file):
+            async with slots:
+                return await self.normalize_audio(audio_file)
+        
+        normalized_files = await asyncio.gather(*(normalize_with_slot(f) for f in audio_files))
+        
+        # Files that failed to normalize are still used, re-encoded per video
+        self.audio_choices = [
+            normalized or audio_file
+            for audio_file, normalized in zip(audio_files, normalized_files)
+        ]
+        
+        cached_count = sum(1 for normalized in normalized_files if normalized)
+        print(f"✅ {cached_count}/{len(audio_files)} audio file(s) cached")
+        return self.audio_choices
+    
+    async def normalize_audio(self, audio_file):
+        """Create (or reuse) a volume-adjusted, trimmed AAC copy of an audio file in the audio cache"""
+        # Every normalization setting is part of the name so changing any of them rebuilds the cache
+        normalized_path = self.audio_cache_dir / (
+            f"{audio_file.stem}-{self.total_duration:g}s-{self.audio_volume}"
+            f"-{self.audio_sample_rate}-{self.audio_channels}ch.m4a"
+        )
+        
+        if normalized_path.exists() and normalized_path.stat().st_mtime >= audio_file.stat().st_mtime:
+            return normalized_path
+        
+        # Encode under a temporary name so an interrupted run never leaves a partial file to reuse
+        temp_path = normalized_path.with_suffix('.tmp.m4a')
+        
+        cmd = [
+            'ffmpeg', *FFMPEG_LOG_ARGS,
+            '-i', str(audio_file),
+            '-vn',
+            '-af', f'volume={self.audio_volume}',  # Reduce volume
+            '-c:a', 'aac',
+            '-b:a', '128k',
+            '-ac', str(self.audio_channels),
+            '-ar', str(self.audio_sample_rate),
+            '-t', str(self.total_duration),  # Trim audio to 15 seconds
+            '-y',
+            str(temp_path)
+        ]
+        
+        returncode, error_lines = await run_ffmpeg_async(cmd)
+        
+        if returncode == 0:
+            os.replace(temp_path, normalized_path)
+            print(f"✅ Cached normalized audio: {normalized_path.name}")
+            return normalized_path
+        
+        print(f"⚠️  Could not normalize audio {audio_file.name}, it will be re-encoded per video")
+        for line in error_lines:
+            print(f"  {line}")
+        if temp_path.exists():
+            temp_path.unlink()
+        return None
+    
+    def get_audio_info(self, audio_file):
+        """Get codec, sample rate and channel count of the first audio stream using FFprobe"""
+        if audio_file in self.audio_info_cache:
+            return self.audio_info_cache[audio_file]
+        
+        cmd = [
+            'ffprobe',
+            '-v', 'error',
+            '-select_streams', 'a:0',
+            '-show_entries', 'stream=codec_name,sample_rate,channels',
+            '-of', 'json',
+            str(audio_file)
+        ]
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True)
+            stream = json.loads(result.stdout)['streams'][0]
+            audio_info = {
+                'codec_name': stream.get('codec_name', ''),
+                'sample_rate': int(stream.get('sample_rate', 0)),
+                'channels': int(stream.get('channels', 0))
+            }
+        except:
+            audio_info = None
+        
+        self.audio_info_cache[audio_file] = audio_info
+        return audio_info
+    
+    def can_copy_audio(self, audio_file):
+        """Check if an audio file is already volume-adjusted and in a format the MP4 muxer can take as-is"""
+        if audio_file.parent != self.audio_cache_dir:
+            return False
+        
+        audio_info = self.get_audio_info(audio_file)
+        return bool(audio_info and
+                    audio_info['codec_name'] in self.copyable_audio_codecs and
+                    audio_info['sample_rate'] == self.audio_sample_rate and
+                    audio_info['channels'] == self.audio_channels)
+    
+    def build_image_index(self):
+        """Scan the input directory once and map each sheet type to its image file"""
+        self._image_index = {}
         if not self.input_dir.exists():
-            return None
+            return
+        
+        # Sorted scan so the first match per type is deterministic
+        for file_path in sorted(self.input_dir.iterdir()):
+            if file_path.suffix.lower() not in self.image_extensions:
+                continue
             
+            name = file_path.name.lower()
+            for filename_type, sheet_type in self.valid_types.items():
+                if filename_type in name and sheet_type not in self._image_index:
+                    self._image_index[sheet_type] = file_path
+    
+    def find_image_by_type(self, image_type):
+        """Find an image file that matches the specified type"""
+        image_path = self._image_index.get(image_type)
+        if image_path:
+            print(f"✅ Found image for type '{image_type}': {image_path.name}")
+            return image_path
+        
         # Convert sheet type back to filename format
         type_mapping = {v: k for k, v in self.valid_types.items()}
         filename_type = type_mapping.get(image_type)
         
         if not filename_type:
             print(f"❌ Unknown image type: {image_type}")
-            return None
-        
-        # Look for files containing the type in their name
-        for file_path in self.input_dir.iterdir():
-            if (file_path.suffix.lower() in self.image_extensions and 
-                filename_type.lower() in file_path.name.lower()):
-                print(f"✅ Found image for type '{image_type}': {file_path.name}")
-                return file_path
-        
-        print(f"❌ No image found for type '{image_type}' (looking for '{filename_type}' in filename)")
+        else:
+            print(f"❌ No image found for type '{image_type}' (looking for '{filename_type}' in filename)")
         return None
     
     def check_dependencies(self):
@@ -141,6 +343,43 @@ class SnapchatEditor:
         
         return True
     
+    def detect_video_encoder(self):
+        """Pick a hardware H.264 encoder if one is available and working, else libx264"""
+        import platform
+        
+        try:
+            result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True)
+            available = result.stdout
+        except Exception:
+            available = ''
+        
+        candidates = ['h264_nvenc', 'h264_qsv']
+        if platform.system() == "Darwin":
+            candidates.insert(0, 'h264_videotoolbox')
+        
+        for encoder in candidates:
+            if encoder not in available:
+                continue
+            
+            # Listed encoders can still lack the device/driver, so try a one-frame encode
+            test_cmd = [
+                'ffmpeg', *FFMPEG_LOG_ARGS,
+                '-f', 'lavfi',
+                '-i', 'color=c=black:s=256x256:d=0.1',
+                '-frames:v', '1',
+                '-c:v', encoder,
+                '-f', 'null', '-'
+            ]
+            returncode, _ = run_ffmpeg(test_cmd)
+            if returncode == 0:
+                self.video_encoder = encoder
+                break
+        else:
+            self.video_encoder = 'libx264'
+        
+        print(f"✅ Video encoder: {self.video_encoder}")
+        return self.video_encoder
+    
     def setup_google_sheets(self):
         """Set up Google Sheets connection"""
         if not self.credentials_path.exists():
@@ -211,76 +450,79 @@ class SnapchatEditor:
             
             print("✅ Google Sheet format validated")
             print(f"📊 Found {len(records)} data rows")
+            self.sheet_rows = records
             return True
             
         except Exception as e:
             print(f"❌ Error checking sheet format: {str(e)}")
             return False
     
-    def get_next_video_sequence_from_sheet(self):
-        """Get next unused sequence of 3 videos (orders 1, 2, 3) from Google Sheets"""
-        try:
-            records = self.worksheet.get_all_records()
+    def iter_video_sequences(self, records):
+        """Yield unused sequences of 3 videos (orders 1, 2, 3) from the fetched Google Sheets records in one pass"""
+        # A sequence is 3 consecutive unused records whose orders are 1, 2 and 3
+        current = []
+        
+        for record in records:
+            if record.used:
+                continue
             
-            # Group unused records by a sequence identifier
-            # We need to find sets of 3 consecutive unused records with orders 1, 2, 3
-            unused_records = []
-            for i, record in enumerate(records):
-                record_used = str(record.get('used?', '')).strip().upper()
-                if record_used == 'FALSE':
-                    unused_records.append({
-                        'row_index': i,
-                        'row_number': i + 2,  # Sheet row (1-indexed + header)
-                        'order': str(record.get('order', '')).strip(),
-                        'type': str(record.get('type', '')).strip(),
-                        'overlay_text': str(record.get('overlay text', '')).strip(),
-                        'mentions_toffee': str(record.get('mentions toffee?', '')).strip()
-                    })
-            
-            print(f"📊 Found {len(unused_records)} unused records total")
-            
-            # Look for a complete sequence (orders 1, 2, 3)
-            # We'll take the first available set of consecutive unused records
-            for start_idx in range(len(unused_records) - 2):
-                sequence = unused_records[start_idx:start_idx + 3]
-                
-                # Check if we have orders 1, 2, 3
-                orders = [record['order'] for record in sequence]
-                if set(orders) == {'1', '2', '3'}:
-                    # Sort by order to ensure correct sequence
-                    sequence.sort(key=lambda x: int(x['order']))
-                    
-                    print(f"✅ Found complete video sequence:")
-                    for i, record in enumerate(sequence, 1):
-                        print(f"  {i}. Order {record['order']}: {record['type']} - \"{record['overlay_text'][:50]}{'...' if len(record['overlay_text']) > 50 else ''}\"")
-                    
-                    return sequence
-            
-            print("❌ No complete unused sequence (orders 1, 2, 3) found in Google Sheets")
-            return None
+            if record.order not in ('1', '2', '3'):
+                current = []
+                continue
             
-        except Exception as e:
-            print(f"❌ Error accessing Google Sheets data: {str(e)}")
-            return None
+            # A repeated order can't share a sequence with its earlier twin
+            current_orders = [entry.order for entry in current]
+            if record.order in current_orders:
+                current = current[current_orders.index(record.order) + 1:]
+            
+            current.append(record)
+            
+            if len(current) < 3:
+                continue
+            
+            # Place each record in its slot to get the correct sequence order
+            sequence = [None, None, None]
+            for entry in current:
+                sequence[int(entry.order) - 1] = entry
+            current = []
+            
+            # Claim the rows locally so they are never handed out twice
+            for entry in sequence:
+                entry.used = True
+            
+            print(f"✅ Found complete video sequence:")
+            for position, entry in enumerate(sequence, 1):
+                print(f"  {position}. Order {entry.order}: {entry.type} - \"{entry.overlay_text[:50]}{'...' if len(entry.overlay_text) > 50 else ''}\"")
+            
+            yield sequence
+        
+        print("❌ No more complete unused sequences (orders 1, 2, 3) found in Google Sheets")
     
-    def mark_sequence_as_used(self, sequence):
-        """Mark a sequence of 3 records as used in Google Sheets"""
+    def mark_sequences_as_used(self, sequences):
+        """Mark sequences of 3 records as used in Google Sheets"""
+        records = [record for sequence in sequences for record in sequence]
         try:
-            for record in sequence:
-                row_number = record['row_number']
-                self.worksheet.update_cell(row_number, 1, 'TRUE')  # Column 1 is 'used?'
-                print(f"📋 Marked row {row_number} as used (Order {record['order']}: {record['type']})")
+            # Column A is 'used?' - write all rows in a single request
+            self.worksheet.batch_update([
+                {'range': f"A{record.row_number}", 'values': [['TRUE']]}
+                for record in records
+            ], value_input_option='USER_ENTERED')  # Same parsing as update_cell
+            
+            for record in records:
+                print(f"📋 Marked row {record.row_number} as used (Order {record.order}: {record.type})")
             
-            print("✅ All 3 records marked as used in Google Sheets")
+            print(f"✅ All {len(records)} records marked as used in Google Sheets")
             return True
             
         except Exception as e:
             print(f"❌ Error updating Google Sheets: {str(e)}")
             return False
     
-    def get_system_font_path(self):
+    @staticmethod
+    @functools.lru_cache(maxsize=1)
+    def get_system_font_path():
         """Get a suitable font path, preferring custom font first"""
-        custom_font_path = self.script_dir / "assets" / "HelveticaNeueRoman.otf"
+        custom_font_path = Path(__file__).parent / "assets" / "HelveticaNeueRoman.otf"
         if custom_font_path.exists():
             return str(custom_font_path)
         
@@ -314,7 +556,11 @@ class SnapchatEditor:
         return None
     
     def get_image_dimensions(self, image_path):
-        """Get image dimensions using FFprobe"""
+        """Get image dimensions using FFprobe (cached per image)"""
+        cache_key = Path(image_path).resolve()
+        if cache_key in self._dims_cache:
+            return self._dims_cache[cache_key]
+        
         cmd = [
             'ffprobe',
             '-v', 'error',
@@ -326,9 +572,11 @@ class SnapchatEditor:
         try:
             result = subprocess.run(cmd, capture_output=True, text=True)
             width, height = map(int, result.stdout.strip().split('x'))
-            return width, height
         except:
-            return 1920, 1080  # Default fallback
+            width, height = 1920, 1080  # Default fallback
+        
+        self._dims_cache[cache_key] = (width, height)
+        return width, height
     
     def calculate_crop_for_9_16(self, img_width, img_height):
         """Calculate crop parameters for 9:16 aspect ratio"""
@@ -364,186 +612,272 @@ class SnapchatEditor:
         random_y = random.randint(min_y, max_y)
         return random_y
     
-    def wrap_text_for_width(self, text, image_width):
-        """Wrap text to fit within the image width"""
+    def calculate_chars_per_line(self, image_width):
+        """Calculate how many characters fit on one line of the overlay"""
         available_width = image_width - 10
         char_width = self.font_size * 0.6
-        chars_per_line = max(30, int(available_width / char_width))
-        
+        return max(30, int(available_width / char_width))
+    
+    @staticmethod
+    def wrap_text_for_width(text, chars_per_line):
+        """Wrap text to the given number of characters per line"""
         wrapped = textwrap.fill(text, width=chars_per_line, break_long_words=False, break_on_hyphens=False)
-        line_count = len(wrapped.split('\n'))
+        line_count = wrapped.count('\n') + 1
         
         return wrapped, line_count
     
-    def create_single_video_segment(self, image_path, overlay_text, output_path, segment_number):
-        """Create a single 5-second video segment without audio"""
-        print(f"🎬 Creating segment {segment_number}: {output_path.name}")
+    def get_image_meta(self, image_path):
+        """Get dimensions and 9:16 crop for an image (cached per image)"""
+        if image_path in self._image_meta:
+            return self._image_meta[image_path]
         
         # Get original image dimensions
         orig_width, orig_height = self.get_image_dimensions(image_path)
-        print(f"📐 Original image dimensions: {orig_width}x{orig_height}")
+        print(f"📐 {image_path.name} original dimensions: {orig_width}x{orig_height}")
         
         # Calculate crop for 9:16 aspect ratio
         crop_width, crop_height, crop_x, crop_y = self.calculate_crop_for_9_16(orig_width, orig_height)
-        print(f"📐 Cropped dimensions: {crop_width}x{crop_height}")
+        print(f"📐 {image_path.name} cropped dimensions: {crop_width}x{crop_height}")
         
-        # Wrap text and calculate bar dimensions
-        wrapped_text, line_count = self.wrap_text_for_width(overlay_text, crop_width)
+        image_meta = {
+            'width': orig_width,
+            'height': orig_height,
+            'crop_width': crop_width,
+            'crop_height': crop_height,
+            'crop_x': crop_x,
+            'crop_y': crop_y
+        }
+        self._image_meta[image_path] = image_meta
+        return image_meta
+    
+    @staticmethod
+    def escape_drawtext_text(text):
+        """Escape text for an unquoted drawtext text= value inside a filter graph"""
+        # First the option-value level, then the filter-graph level
+        for special_chars in ("\\':", "\\'[],;"):
+            text = ''.join(f"\\{char}" if char in special_chars else char for char in text)
+        return text
+    
+    def build_segment_filter(self, input_index, image_path, overlay_text, font_param, output_size, chars_per_line):
+        """Build the crop + scale + text overlay filter chain for one segment input"""
+        segment_number = input_index + 1
+        output_width, output_height = output_size
+        
+        # Crop only depends on the image
+        image_meta = self.get_image_meta(image_path)
+        crop_width = image_meta['crop_width']
+        crop_height = image_meta['crop_height']
+        crop_x = image_meta['crop_x']
+        crop_y = image_meta['crop_y']
+        
+        # Wrap text and calculate bar dimensions at the shared output size
+        wrapped_text, line_count = self.wrap_text_for_width(overlay_text, chars_per_line)
         text_height = line_count * self.font_size
         bar_height = text_height + (self.text_padding * 2)
         
         # Calculate random bar position
-        bar_y_position = self.calculate_random_bar_position(crop_height, bar_height)
-        position_percent = (bar_y_position / crop_height) * 100
-        print(f"🎲 Random bar position: {bar_y_position}px ({position_percent:.1f}%)")
-        
-        # Create temporary text file
-        text_file = self.temp_dir / f"overlay_text_segment_{segment_number}.txt"
-        with open(text_file, 'w', encoding='utf-8') as f:
-            f.write(wrapped_text)
+        bar_y_position = self.calculate_random_bar_position(output_height, bar_height)
+        position_percent = (bar_y_position / output_height) * 100
+        print(f"🎲 Segment {segment_number} random bar position: {bar_y_position}px ({position_percent:.1f}%)")
         
-        # Get font
-        font_param = ''
-        system_font = self.get_system_font_path()
-        if system_font:
-            font_param = f":fontfile='{system_font}'"
-        
-        # Create filter for black overlay with cropping (NO AUDIO)
-        filter_complex = (
-            f"[0:v]crop={crop_width}:{crop_height}:{crop_x}:{crop_y}[cropped];"
-            f"[cropped]drawbox="
-            f"x=0:y={bar_y_position}:w={crop_width}:h={bar_height}:"
-            f"color=black@{self.bar_opacity}:t=fill[with_bar];"
-            f"[with_bar]drawtext="
-            f"textfile='{str(text_file)}'"
+        # Crop and scale to the output size first so text renders at the same size in every segment,
+        # then draw the text with its black bar in a single drawtext pass
+        segment_filter = (
+            f"[{input_index}:v]crop={crop_width}:{crop_height}:{crop_x}:{crop_y},"
+            f"scale={output_width}:{output_height},setsar=1,"
+            f"drawtext="
+            f"text={self.escape_drawtext_text(wrapped_text)}"
+            f":expansion=none"  # Keep % in overlay text literal
             f"{font_param}"
             f":fontsize={self.font_size}"
             f":fontcolor=white"
             f":x=(w-text_w)/2"
             f":y={bar_y_position}+({bar_height}-text_h)/2"
             f":text_align=C"
+            f":box=1"
+            f":boxcolor=black@{self.bar_opacity}"
+            f":boxborderw={self.text_padding}"
+            f"[v{input_index}]"
         )
         
-        cmd = [
-            'ffmpeg',
-            '-loop', '1',
-            '-i', str(image_path),
-            '-filter_complex', filter_complex,
-            '-t', str(self.segment_duration),  # 5 seconds
-            '-r', str(self.fps),
+        return segment_filter
+    
+    def get_video_encoder_args(self, threads):
+        """Get the FFmpeg video encoding arguments for the selected encoder"""
+        keyint = int(self.fps * self.keyframe_interval)
+        
+        if self.video_encoder == 'h264_nvenc':
+            return [
+                '-c:v', 'h264_nvenc',
+                '-preset', 'p4',
+                '-rc', 'constqp',
+                '-qp', '23',
+                '-g', str(keyint),
+                '-pix_fmt', 'yuv420p',
+            ]
+        if self.video_encoder == 'h264_videotoolbox':
+            return [
+                '-c:v', 'h264_videotoolbox',
+                '-b:v', '4M',
+                '-g', str(keyint),
+                '-pix_fmt', 'yuv420p',
+            ]
+        if self.video_encoder == 'h264_qsv':
+            return [
+                '-c:v', 'h264_qsv',
+                '-global_quality', '23',
+                '-g', str(keyint),
+                '-pix_fmt', 'nv12',
+            ]
+        
+        return [
             '-c:v', 'libx264',
-            '-preset', 'medium',
+            '-preset', 'ultrafast',  # Motion search is wasted on static frames
+            '-tune', 'stillimage',
+            '-x264-params', f'keyint={keyint}:min-keyint={keyint}:scenecut=0',
             '-crf', '23',
             '-pix_fmt', 'yuv420p',
-            '-y',
-            str(output_path)
+            '-threads', str(threads),  # Share the CPU between parallel encodes
         ]
-        
-        try:
-            print(f"🔄 Processing segment {segment_number} ({self.segment_duration}s)...")
-            
-            process = subprocess.run(cmd, capture_output=True, text=True)
-            
-            # Clean up text file
-            if text_file.exists():
-                text_file.unlink()
-            
-            if process.returncode == 0:
-                print(f"✅ Segment {segment_number} created successfully")
-                return True
-            else:
-                print(f"❌ FFmpeg error for segment {segment_number}")
-                print("Error details:")
-                for line in process.stderr.split('\n')[-5:]:
-                    if line.strip():
-                        print(f"  {line.strip()}")
-                return False
-                
-        except Exception as e:
-            print(f"❌ Error creating segment {segment_number}: {str(e)}")
-            if text_file.exists():
-                text_file.unlink()
-            return False
     
-    def concatenate_videos_with_audio(self, video_paths, output_path, audio_file=None):
-        """Concatenate 3 videos and add audio to create final 15-second video"""
-        print(f"🔗 Concatenating {len(video_paths)} videos into final 15-second video...")
+    def get_output_movflags(self):
+        """Get MP4 layout flags for the final video"""
+        if self.streamable_output:
+            # Relocating moov costs one extra pass over the file
+            return '+faststart'
+        # Fragmented MP4 is written in its final layout with no second pass
+        return '+frag_keyframe+empty_moov+default_base_moof'
+    
+    def build_sequence_command(self, segments, output_path, audio_file, threads):
+        """Build the single FFmpeg command that encodes 3 (image, text) segments, concatenates them and adds audio"""
+        cmd = ['ffmpeg', *FFMPEG_LOG_ARGS]
+        filters = []
         
-        # Create concat file for FFmpeg
-        concat_file = self.temp_dir / "concat_list.txt"
-        with open(concat_file, 'w') as f:
-            for video_path in video_paths:
-                f.write(f"file '{video_path.absolute()}'\n")
+        # The concat filter needs every segment at the same (even) size; use the first segment's crop
+        first_meta = self.get_image_meta(segments[0][0])
+        output_size = (
+            first_meta['crop_width'] - first_meta['crop_width'] % 2,
+            first_meta['crop_height'] - first_meta['crop_height'] % 2
+        )
+        chars_per_line = self.calculate_chars_per_line(output_size[0])
         
-        cmd = [
-            'ffmpeg',
-            '-f', 'concat',
-            '-safe', '0',
-            '-i', str(concat_file),
-        ]
+        # Get font once; every segment's drawtext shares it
+        font_param = ''
+        system_font = self.get_system_font_path()
+        if system_font:
+            font_param = f":fontfile='{system_font}'"
+        
+        for i, (image_path, overlay_text) in enumerate(segments):
+            cmd.extend([
+                '-loop', '1',
+                '-framerate', str(self.fps),
+                '-t', str(self.segment_duration),  # 5 seconds
+                '-i', str(image_path),
+            ])
+            
+            filters.append(self.build_segment_filter(
+                i, image_path, overlay_text, font_param, output_size, chars_per_line
+            ))
+        
+        concat_inputs = ''.join(f"[v{i}]" for i in range(len(segments)))
+        filters.append(f"{concat_inputs}concat=n={len(segments)}:v=1:a=0[v]")
         
         # Add audio input if available
         if audio_file:
             cmd.extend(['-i', str(audio_file)])
-            print(f"🎵 Adding audio: {audio_file.name}")
         
-        # Video processing
         cmd.extend([
-            '-c:v', 'copy',  # Copy video without re-encoding for speed
+            '-filter_complex', ';'.join(filters),
+            '-map', '[v]',
         ])
         
         # Audio processing if available
         if audio_file:
-            cmd.extend([
-                '-af', f'volume=-10dB',  # Reduce volume
-                '-c:a', 'aac',
-                '-b:a', '128k',
-                '-ac', '2',
-                '-ar', '44100',
-                '-t', str(self.total_duration),  # Trim audio to 15 seconds
-            ])
+            cmd.extend(['-map', f'{len(segments)}:a'])
+            if self.can_copy_audio(audio_file):
+                cmd.extend(['-c:a', 'copy'])  # Already normalized, just remux
+            else:
+                cmd.extend([
+                    '-af', f'volume={self.audio_volume}',  # Reduce volume
+                    '-c:a', 'aac',
+                    '-b:a', '128k',
+                    '-ac', str(self.audio_channels),
+                    '-ar', str(self.audio_sample_rate),
+                ])
         
         cmd.extend([
-            '-movflags', '+faststart',
+            '-r', str(self.fps),
+            *self.get_video_encoder_args(threads),
+            '-t', str(self.total_duration),  # Trim to 15 seconds
+            '-movflags', self.get_output_movflags(),
             '-y',
             str(output_path)
         ])
         
-        try:
-            print(f"🔄 Concatenating videos and adding audio...")
-            
-            process = subprocess.run(cmd, capture_output=True, text=True)
-            
-            # Clean up concat file
-            if concat_file.exists():
-                concat_file.unlink()
-            
-            if process.returncode == 0:
-                print(f"✅ Final video created successfully: {output_path.name}")
-                print(f"📹 Duration: {self.total_duration}s ({len(video_paths)} segments of {self.segment_duration}s each)")
-                if audio_file:
-                    print(f"🎵 Audio: {audio_file.name} (trimmed to {self.total_duration}s)")
-                return True
-            else:
-                print(f"❌ FFmpeg concatenation error")
-                print("Error details:")
-                for line in process.stderr.split('\n')[-10:]:
-                    if line.strip():
-                        print(f"  {line.strip()}")
-                return False
-                
-        except Exception as e:
-            print(f"❌ Error concatenating videos: {str(e)}")
-            if concat_file.exists():
-                concat_file.unlink()
-            return False
+        return cmd
     
     def generate_output_filename(self, sequence_number):
         """Generate output filename for the sequence"""
         return self.output_dir / f"sequence-{sequence_number:03d}-video.mp4"
     
+    def make_progress_reporter(self, sequence_number):
+        """Build a callback that prints encode progress for a sequence in 25% steps"""
+        last_step = 0
+        
+        def report(encoded_seconds):
+            nonlocal last_step
+            percent = min(100, int(encoded_seconds / self.total_duration * 100))
+            if percent // 25 > last_step:
+                last_step = percent // 25
+                print(f"⏳ Sequence #{sequence_number}: {percent}% encoded")
+        
+        return report
+    
+    async def process_sequence_job(self, job, cmd, encode_slots, sheets_lock):
+        """Encode one claimed sequence, then mark it as used in Google Sheets"""
+        try:
+            async with encode_slots:
+                print(f"🔄 Encoding sequence #{job['sequence_number']}...")
+                returncode, error_lines = await run_ffmpeg_async(
+                    cmd, on_progress=self.make_progress_reporter(job['sequence_number'])
+                )
+        except Exception as e:
+            print(f"\n❌ Error creating video for sequence #{job['sequence_number']}: {str(e)}")
+            return False
+        
+        if returncode != 0:
+            print(f"\n❌ Failed to create final video for sequence #{job['sequence_number']}")
+            print("Error details:")
+            for line in error_lines:
+                print(f"  {line}")
+            return False
+        
+        # The encode slot is already free, so the Sheets round-trip overlaps the next encode
+        async with sheets_lock:
+            marked = await asyncio.to_thread(self.mark_sequences_as_used, [job['sequence']])
+        
+        print(f"\n🎉 SUCCESS for sequence #{job['sequence_number']}!")
+        print(f"✅ Final video: {job['output_path'].name}")
+        print(f"✨ Features applied:")
+        print(f"   • 3 segments of {self.segment_duration}s each")
+        print(f"   • Total duration: {self.total_duration}s")
+        print(f"   • Each segment cropped to 9:16 aspect ratio")
+        print(f"   • Black bar overlays at random positions")
+        print(f"   • White centered text from Google Sheets")
+        if job['audio_file']:
+            print(f"   • Random TikTok audio: {job['audio_file'].name} (trimmed to {self.total_duration}s)")
+        if marked:
+            print(f"   • Google Sheets automatically updated (3 rows marked as used)")
+        else:
+            print(f"⚠️  Video created but failed to update Google Sheets")
+        return True
+    
     def run(self):
         """Main execution function"""
+        return asyncio.run(self.run_async())
+    
+    async def run_async(self):
+        """Main execution loop; FFmpeg encodes and Google Sheets writes overlap on the event loop"""
         print("📱 Snapchat Style 3-Image Video Editor with Google Sheets Integration")
         print("=" * 80)
         
@@ -551,6 +885,8 @@ class SnapchatEditor:
         if not self.check_dependencies():
             return False
         
+        self.detect_video_encoder()
+        
         # Set up Google Sheets connection
         if not self.setup_google_sheets():
             return False
@@ -564,10 +900,17 @@ class SnapchatEditor:
         # Ensure directories exist
         self.input_dir.mkdir(parents=True, exist_ok=True)
         self.output_dir.mkdir(parents=True, exist_ok=True)
-        self.temp_dir.mkdir(parents=True, exist_ok=True)
         self.audio_dir.mkdir(parents=True, exist_ok=True)
+        self.audio_cache_dir.mkdir(parents=True, exist_ok=True)
         (self.script_dir / "assets").mkdir(parents=True, exist_ok=True)
         
+        # Index input images once instead of rescanning per segment
+        self.build_image_index()
+        
+        # Precompute the image-dependent crop settings
+        for image_path in self._image_index.values():
+            self.get_image_meta(image_path)
+        
         print(f"✅ Using Google Sheet: {self.worksheet.spreadsheet.title}")
         print(f"📄 Worksheet: {self.worksheet_name}")
         
@@ -580,112 +923,91 @@ class SnapchatEditor:
         
         # Check for image files
         print(f"\n🏷️  Valid image types: {', '.join(self.valid_types.keys())}")
-        missing_types = []
-        for filename_type, sheet_type in self.valid_types.items():
-            if not self.find_image_by_type(sheet_type):
-                missing_types.append(filename_type)
+        missing_sheet_types = set(self.valid_types.values()) - set(self._image_index.keys())
+        missing_types = [
+            filename_type for filename_type, sheet_type in self.valid_types.items()
+            if sheet_type in missing_sheet_types
+        ]
         
         if missing_types:
             print(f"❌ Missing image types: {', '.join(missing_types)}")
             print("Please ensure you have images for all types in the input-images folder")
             return False
         
+        # Normalize audio only once the run is known to be valid
+        if audio_files:
+            await self.prepare_audio_cache(audio_files)
+        
         print(f"\n⚙️  Video Settings:")
         print(f"   • Segment duration: {self.segment_duration}s (3 segments)")
         print(f"   • Total duration: {self.total_duration}s")
         print(f"   • Frame rate: {self.fps} fps")
+        print(f"   • Video encoder: {self.video_encoder}")
         print(f"   • Aspect ratio: 9:16 (cropped)")
         print(f"   • Text source: Google Sheets (orders 1, 2, 3)")
         print(f"   • Audio source: {'Random from tiktok-audio' if audio_files else 'None'}")
         
+        # Reuse the rows fetched by check_sheet_format(); sequences are claimed from this local copy
+        records = [
+            SheetRecord.from_sheet_row(i + 2, row)  # Sheet row (1-indexed + header)
+            for i, row in enumerate(self.sheet_rows)
+        ]
+        
         # Process video sequences
         successful_videos = 0
         failed_videos = 0
         sequence_number = 1
+        claimed_jobs = []
+        sequences = self.iter_video_sequences(records)
         
+        # First pass: claim sequences from the local records and resolve their inputs
         while True:
             print(f"\n" + "="*80)
-            print(f"🔄 Processing Video Sequence #{sequence_number}")
+            print(f"🔄 Preparing Video Sequence #{sequence_number}")
             print("="*80)
             
             # Get next sequence from Google Sheets
-            sequence = self.get_next_video_sequence_from_sheet()
+            sequence = next(sequences, None)
             if not sequence:
-                print(f"⏹️  No more complete sequences available. Stopping.")
+                print(f"⏹️  No more complete sequences available.")
                 break
             
             # Generate output filename
             final_output_path = self.generate_output_filename(sequence_number)
             print(f"📁 Final output: {final_output_path.name}")
             
-            # Create individual segments
-            segment_paths = []
-            all_segments_created = True
+            # Find the image for each segment
+            segments = []
+            all_images_found = True
             
             for i, record in enumerate(sequence, 1):
-                print(f"\n📸 Creating segment {i}/3 (Order {record['order']}):")
-                print(f"   Type: {record['type']}")
-                print(f"   Text: {record['overlay_text'][:80]}{'...' if len(record['overlay_text']) > 80 else ''}")
+                print(f"\n📸 Segment {i}/3 (Order {record.order}):")
+                print(f"   Type: {record.type}")
+                print(f"   Text: {record.overlay_text[:80]}{'...' if len(record.overlay_text) > 80 else ''}")
                 
                 # Find corresponding image
-                image_path = self.find_image_by_type(record['type'])
+                image_path = self.find_image_by_type(record.type)
                 if not image_path:
-                    print(f"❌ No image found for type: {record['type']}")
-                    all_segments_created = False
+                    print(f"❌ No image found for type: {record.type}")
+                    all_images_found = False
                     break
                 
-                # Create segment output path
-                segment_output = self.temp_dir / f"segment_{sequence_number}_{i}.mp4"
-                
-                # Create the segment
-                if self.create_single_video_segment(image_path, record['overlay_text'], segment_output, i):
-                    segment_paths.append(segment_output)
-                else:
-                    print(f"❌ Failed to create segment {i}")
-                    all_segments_created = False
-                    break
+                segments.append((image_path, record.overlay_text))
             
-            if not all_segments_created:
-                print(f"❌ Failed to create complete sequence #{sequence_number}")
-                # Clean up any created segments
-                for path in segment_paths:
-                    if path.exists():
-                        path.unlink()
-                failed_videos += 1
-                sequence_number += 1
-                continue
-            
-            # Select random audio for final video
-            audio_file = self.select_random_audio() if audio_files else None
-            
-            # Concatenate segments and add audio
-            if self.concatenate_videos_with_audio(segment_paths, final_output_path, audio_file):
-                # Mark sequence as used in Google Sheets
-                if self.mark_sequence_as_used(sequence):
-                    print(f"\n🎉 SUCCESS for sequence #{sequence_number}!")
-                    print(f"✅ Final video: {final_output_path.name}")
-                    print(f"✨ Features applied:")
-                    print(f"   • 3 segments of {self.segment_duration}s each")
-                    print(f"   • Total duration: {self.total_duration}s")
-                    print(f"   • Each segment cropped to 9:16 aspect ratio")
-                    print(f"   • Black bar overlays at random positions")
-                    print(f"   • White centered text from Google Sheets")
-                    if audio_file:
-                        print(f"   • Random TikTok audio (trimmed to {self.total_duration}s)")
-                    print(f"   • Google Sheets automatically updated (3 rows marked as used)")
-                    successful_videos += 1
-                else:
-                    print(f"⚠️  Video created but failed to update Google Sheets")
-                    successful_videos += 1
+            if all_images_found:
+                # Select random audio for final video
+                audio_file = self.select_random_audio() if audio_files else None
+                claimed_jobs.append({
+                    'sequence_number': sequence_number,
+                    'sequence': sequence,
+                    'segments': segments,
+                    'audio_file': audio_file,
+                    'output_path': final_output_path
+                })
             else:
-                print(f"❌ Failed to create final video for sequence #{sequence_number}")
+                print(f"❌ Failed to create complete sequence #{sequence_number}")
                 failed_videos += 1
             
-            # Clean up temporary segment files
-            for path in segment_paths:
-                if path.exists():
-                    path.unlink()
-            
             sequence_number += 1
             
             # Safety limit to prevent infinite loops
@@ -693,6 +1015,35 @@ class SnapchatEditor:
                 print("⚠️  Reached safety limit of 100 sequences")
                 break
         
+        # Second pass: encode the claimed sequences in parallel
+        if claimed_jobs:
+            cpu_count = os.cpu_count() or 1
+            workers = max(1, min(cpu_count // 2, len(claimed_jobs)))
+            if self.video_encoder != 'libx264':
+                workers = max(1, min(workers, self.max_hardware_encodes))
+            threads = max(1, cpu_count // workers)
+            
+            commands = [
+                self.build_sequence_command(job['segments'], job['output_path'], job['audio_file'], threads)
+                for job in claimed_jobs
+            ]
+            
+            if self.video_encoder == 'libx264':
+                print(f"\n🔄 Encoding {len(claimed_jobs)} video(s) with {workers} worker(s), {threads} thread(s) each...")
+            else:
+                print(f"\n🔄 Encoding {len(claimed_jobs)} video(s) with {workers} {self.video_encoder} session(s)...")
+            
+            # Encodes share a fixed number of slots; Sheets writes go one at a time
+            encode_slots = asyncio.Semaphore(workers)
+            sheets_lock = asyncio.Lock()
+            results = await asyncio.gather(*(
+                self.process_sequence_job(job, cmd, encode_slots, sheets_lock)
+                for job, cmd in zip(claimed_jobs, commands)
+            ))
+            
+            successful_videos += sum(1 for success in results if success)
+            failed_videos += sum(1 for success in results if not success)
+        
         # Summary
         print(f"\n" + "="*80)
         print(f"📊 PROCESSING SUMMARY")